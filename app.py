@@ -1,27 +1,63 @@
 
-from flask import Flask, request, jsonify, session
+from flask import Flask, Response, request, jsonify, session, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-from flask_session import Session
-from pydantic import BaseModel, model_validator
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
 import logging
 import time
-from openai import OpenAI
+from openai import OpenAI, NotFoundError, DefaultHttpxClient
+import httpx
 import os
-from datetime import datetime, timedelta
 import hashlib
 from celery import Celery
+from celery.exceptions import Ignore
+from celery.signals import task_success, worker_process_init
+from kombu.serialization import register
 from celery.result import AsyncResult
 import redis
+from redis.exceptions import LockNotOwnedError
 import json
+import orjson
+import re
 import ssl
+import threading
+import uuid
+from contextlib import contextmanager
+
+class ORJSONProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, used by request.get_json() and jsonify"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 CORS(app)
-logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+# Only configure the root logger once, even if the module is imported again under a reloader
+if not logging.getLogger().handlers:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-client = OpenAI()
+# Required settings are read once at import so a misconfigured container fails at start-up
+OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+
+def create_openai_client():
+    """Build the OpenAI client shared by the requests or tasks of one process"""
+    # Many small Assistants API calls share this pool; HTTP/2 multiplexes them over fewer TLS connections
+    # Rate-limited (429) calls are retried by the SDK, which backs off using the Retry-After header
+    return OpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=5,
+        http_client=DefaultHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=60.0)
+        )
+    )
+
+client = create_openai_client()
 
 instructions = """
 You are an ARFID expert. Based on the imputed safe foods, avoided foods, and restrictions, generate exactly 15 meal recommendations. Each recommendation should build on one of the safe foods or provide an alternative to one of the avoided foods.
@@ -41,23 +77,105 @@ In addition, the response should take a subset of recommendations and rank them
 The return response should be a string of a JSON object. The JSON object needs to match the format of arfid.json The web application will parse it.
 """
 
-def get_redis_connection(url):
-    """Create Redis connection with proper SSL configuration for rediss:// URLs"""
+# Structured output the assistant must follow. The models generate the response_format schema
+# and validate each reply before it reaches the client, so the two cannot drift apart.
+class ARFIDFood(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    food: str = Field(description="The name of the food item.")
+    goal: str = Field(description="The intended goal of including this food item.")
+    transition_strategy: str = Field(description="A strategy for transitioning the patient to accept this food.")
+    allergy_considerations: str = Field(description="Precautions or considerations for the food item.")
+
+class ARFIDRecommendation(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    category: str = Field(description="The category of the meal recommendations.")
+    foods: list[ARFIDFood] = Field(
+        description="A list of food items with their respective goals and transition strategies."
+    )
+
+class ARFIDNote(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    type: str = Field(description="The type of note (e.g., caution, encouragement).")
+    content: str = Field(description="The content of the note.")
+
+class ARFIDRecommendationEase(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    recommendation: str = Field(description="The recommendation for the patient.")
+    ease: str = Field(description="An explanation of why the recommendation is easy to implement.")
+    accomplishment: str = Field(description="An explanation of what the recommendation accomplishes.")
+    preparation: str = Field(description="An explanation of how the recommendation can be prepared.")
+
+class ARFIDResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    title: str = Field(description="The title of the meal recommendation schema.")
+    description: str = Field(description="A description of the purpose of the meal recommendations.")
+    recommendations: list[ARFIDRecommendation] = Field(
+        description="A list of meal recommendations categorized by type."
+    )
+    notes: list[ARFIDNote] = Field(
+        description="Additional notes or remarks regarding the meal recommendations."
+    )
+    recommendation_ease: list[ARFIDRecommendationEase] = Field(
+        description="A list of recommendations with their ease of implementation."
+    )
+
+ARFID_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "ARFID_Meal_Recommendations",
+        "schema": ARFIDResponse.model_json_schema(),
+        "strict": True
+    }
+}
+
+# Upper bound on open Redis connections per process; callers wait for a free one instead of failing
+REDIS_MAX_CONNECTIONS = 64
+# Pools that raise instead of waiting when full (pub/sub and Celery's result backend) are sized
+# well above gunicorn's --worker-connections and the worker's gevent concurrency. redis-py
+# otherwise caps them at 100.
+REDIS_NONBLOCKING_MAX_CONNECTIONS = 1000
+
+def get_redis_connection_pool(url, decode_responses=False, pool_class=redis.BlockingConnectionPool,
+                              max_connections=REDIS_MAX_CONNECTIONS):
+    """Create a Redis connection pool with proper SSL configuration for rediss:// URLs"""
     if url.startswith('rediss://'):
-        return redis.from_url(
+        return pool_class.from_url(
             url,
+            max_connections=max_connections,
+            decode_responses=decode_responses,
             ssl_cert_reqs=ssl.CERT_NONE
         )
-    return redis.from_url(url)
+    return pool_class.from_url(
+        url, max_connections=max_connections, decode_responses=decode_responses
+    )
+
+REDIS_URL = os.environ["REDIS_URL"]
+# App values are all text, so the client decodes replies once in the parser (hiredis when
+# installed) instead of every caller decoding bytes
+redis_client = redis.Redis(connection_pool=get_redis_connection_pool(REDIS_URL, decode_responses=True))
+# Each /api/stream subscriber holds a connection for up to STREAM_TIMEOUT. They get their own
+# pool so open streams can never use up the connections the rest of the app waits on.
+pubsub_client = redis.Redis(connection_pool=get_redis_connection_pool(
+    REDIS_URL, decode_responses=True, pool_class=redis.ConnectionPool,
+    max_connections=REDIS_NONBLOCKING_MAX_CONNECTIONS
+))
+
+# Extend or delete a claim only while it still holds the caller's value
+refresh_if_owner = redis_client.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end return 0"
+)
+delete_if_owner = redis_client.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+)
 
-REDIS_URL = os.environ.get("REDIS_URL")
+# Each session's assistant mapping and OpenAI thread are stored under its assistant key rather
+# than in process-wide state, so concurrent users and workers never share a thread. Both expire
+# on their own, so sessions that never call /api/end do not accumulate in Redis.
+SESSION_TTL = 24 * 60 * 60
 
-app.config["SESSION_TYPE"]="redis"
-app.config["SESSION_PERMANENT"]=False
-app.config["SESSION_USE_SIGNER"]=True
-app.config["SESSION_KEY_PREFIX"]="flask_session:"
-app.config["SESSION_REDIS"]=get_redis_connection(REDIS_URL)
-app.config["SECRET_KEY"]=os.environ.get("FLASK_SECRET_KEY")
+# The session only holds assistant_key, so it lives in Flask's signed cookie rather than
+# costing a Redis read on every request. Signing needs the key, so it is required up front.
+app.config["SECRET_KEY"]=os.environ["FLASK_SECRET_KEY"]
 
 # Configure Celery with SSL parameters for rediss:// URLs
 if REDIS_URL.startswith('rediss://'):
@@ -72,21 +190,156 @@ else:
         CELERY_RESULT_BACKEND=REDIS_URL,
     )
 
-Session(app)
 celery = Celery(
     app.import_name,
     backend=app.config["CELERY_RESULT_BACKEND"],
     broker=app.config["CELERY_BROKER_URL"]
 )
-redis_client = get_redis_connection(REDIS_URL)
-
+TASK_VISIBILITY_TIMEOUT = 60 * 60
+# Task arguments and multi-KB recommendation results go through orjson rather than stdlib json
+register("orjson", orjson.dumps, orjson.loads, content_type="application/x-orjson", content_encoding="binary")
+# Tasks spend nearly all their time waiting on OpenAI, so workers run a gevent pool with
+# high concurrency and only reserve one task at a time; acks_late requeues work lost with a worker.
+# The visibility timeout must outlast the longest run or Redis redelivers it mid-flight.
+celery.conf.update(
+    task_serializer="orjson",
+    result_serializer="orjson",
+    accept_content=["orjson", "json"],
+    result_accept_content=["orjson", "json"],
+    redis_max_connections=REDIS_NONBLOCKING_MAX_CONNECTIONS,
+    worker_prefetch_multiplier=1,
+    task_acks_late=True,
+    broker_transport_options={"visibility_timeout": TASK_VISIBILITY_TIMEOUT, "socket_keepalive": True},
+    # Each gevent web worker can enqueue from hundreds of requests at once; let publishes reuse
+    # pooled broker connections instead of waiting on the default pool of 10
+    broker_pool_limit=REDIS_MAX_CONNECTIONS,
+    broker_connection_retry_on_startup=True,
+    redis_socket_keepalive=True,
+    redis_retry_on_timeout=True,
+)
 
-ongoing_tasks = {}
-assistants = {}
+@worker_process_init.connect
+def reset_openai_client(**kwargs):
+    """Give each forked worker process its own OpenAI connection pool instead of the parent's"""
+    # Only prefork children fire this signal; the gevent pool runs in one process and keeps
+    # the client created at import
+    global client
+    inherited, client = client, create_openai_client()
+    inherited.close()
 
 # Vector store ID from pre-uploaded PDFs (set via environment variable)
 # This is created once by running: python scripts/upload-pdfs-to-openai.py
 OPENAI_VECTOR_STORE_ID = os.environ.get("OPENAI_VECTOR_STORE_ID")
+# Optional pre-created assistant to use as is. New sessions then skip the configuration lookup
+# and OpenAI verification in setup_assistant_task, and returning sessions mapped to it skip the
+# verification in /api/start. Leave unset to have the app create and track one per configuration.
+OPENAI_ASSISTANT_ID = os.environ.get("OPENAI_ASSISTANT_ID")
+
+# Create assistant with existing vector store (no file upload needed!)
+ASSISTANT_PARAMS = dict(
+    name="ARFID Assistant",
+    description="This tool assists medical professionals and patients with identifying food options for patients with ARFID.",
+    instructions=instructions,
+    model="o3-mini",
+    tools=[{"type": "file_search"}],
+    tool_resources={"file_search": {"vector_store_ids": [OPENAI_VECTOR_STORE_ID]}},
+    response_format=ARFID_RESPONSE_FORMAT,
+    reasoning_effort="medium"
+)
+
+# Fingerprint of the assistant configuration, used to reuse assistants across sessions
+ASSISTANT_FINGERPRINT = hashlib.sha256(json.dumps(ASSISTANT_PARAMS, sort_keys=True).encode("utf-8")).hexdigest()
+
+# Completed responses are cached by patient inputs so repeat requests skip the OpenAI run.
+# The answering assistant is part of the key so sessions still on an assistant from before a
+# prompt or schema change never serve their output to sessions on the new one.
+RESPONSE_CACHE_TTL = 6 * 60 * 60
+RESPONSE_CACHE_PREFIX = "cached:"
+# The only keys a cached: task id may name; anything else would let clients read arbitrary keys
+RESPONSE_CACHE_KEY_PATTERN = re.compile(r"resp:[0-9a-f]{32}")
+
+# Finished run_openai_task results are published here so /api/stream can push them to the client
+RESULT_CHANNEL_PREFIX = "result:"
+STREAM_TIMEOUT = 10 * 60
+STREAM_KEEPALIVE_INTERVAL = 15
+# Text generated so far is published here while the run streams, batched to limit publishes
+DELTA_CHANNEL_PREFIX = "delta:"
+DELTA_PUBLISH_INTERVAL = 0.25
+
+# User turns sent to the assistant, assembled once at import and filled per request
+INITIAL_MESSAGE_TEMPLATE = "\n\n".join([
+    "Include these foods of patients {likes}",
+    "Do not include these foods patient doesn't like or eats: {dislikes}",
+    "Each recommendation should build on one of these foods {likes} or provide an alternative to one of these foods {dislikes}",
+    "Patient is allergic or has restrictions and can't eat: {restrictions}",
+])
+SELECTIONS_MESSAGE_TEMPLATE = "\n\n".join([
+    "Updates from user: {update}",
+    "The user has provided the following recommendations: {recommendations}, please give more suggestions like that.",
+    "Please provide 20 recommendations in the same format as before.",
+])
+
+# Identical initial requests run once: the first claims inflight:<cache key> and the threads
+# of the ones that join it are queued under waiters:<cache key> to receive the answer. The
+# claim is short-lived and refreshed by the running task, so a lost leader stops attracting
+# joiners within INFLIGHT_TTL.
+INFLIGHT_PREFIX = "inflight:"
+WAITERS_PREFIX = "waiters:"
+INFLIGHT_TTL = 2 * 60
+
+# Assistant creation gets its own per-attempt timeout and retry budget so its worst case,
+# including Retry-After waits (capped at two minutes by the SDK), fits inside the lock.
+# A lock that expired mid-call would let another session create a duplicate assistant.
+ASSISTANT_CREATE_TIMEOUT = 30
+ASSISTANT_CREATE_MAX_RETRIES = 2
+ASSISTANT_CREATE_LOCK_TIMEOUT = (
+    (ASSISTANT_CREATE_MAX_RETRIES + 1) * ASSISTANT_CREATE_TIMEOUT + ASSISTANT_CREATE_MAX_RETRIES * 120 + 30
+)
+
+# Marks a run_openai_task delivery as running so broker redeliveries are not run twice. The
+# claim is short-lived and refreshed while the run lasts, so it lapses soon after a worker dies.
+RUN_CLAIM_PREFIX = "run_claim:"
+RUN_CLAIM_TTL = 60
+
+@contextmanager
+def keep_alive(refresh, interval):
+    """Call refresh every interval seconds in the background while the block runs"""
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(interval):
+            try:
+                refresh()
+            except Exception as e:
+                logger.error("Error refreshing claim: %s", e)
+
+    # A plain thread becomes a greenlet under the gevent pool
+    heartbeat = threading.Thread(target=beat, daemon=True)
+    heartbeat.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+
+def normalize_food_list(value):
+    """Lowercase, dedupe and sort a comma, semicolon or newline separated list of foods"""
+    if isinstance(value, (list, tuple)):
+        value = ",".join(str(item) for item in value)
+    items = set()
+    for item in re.split(r"[,;\n]", value or ""):
+        # "Plain  Pasta." and "plain pasta" are the same food and should share a cache entry
+        item = " ".join(item.lower().split()).strip(" .!\"'")
+        if item:
+            items.add(item)
+    return ", ".join(sorted(items))
+
+def get_response_cache_key(assistant_id, likes, dislikes, restrictions):
+    """Build the Redis key for assistant_id's cached response to the given patient inputs"""
+    payload = json.dumps(
+        {"l": likes, "d": dislikes, "r": restrictions, "v": assistant_id},
+        sort_keys=True
+    )
+    return f"resp:{hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()}"
 
 @app.before_request
 def handle_options():
@@ -101,168 +354,59 @@ def setup_assistant_task():
     try:
         with app.app_context():
             # Check if vector store ID is configured
-            if not OPENAI_VECTOR_STORE_ID:
+            if not OPENAI_ASSISTANT_ID and not OPENAI_VECTOR_STORE_ID:
                 logger.error("OPENAI_VECTOR_STORE_ID environment variable not set")
                 return {"error": "Vector store not configured. Please run scripts/upload-pdfs-to-openai.py and set OPENAI_VECTOR_STORE_ID in GitHub Secrets."}
 
-            logger.info(f"Creating new assistant with vector store: {OPENAI_VECTOR_STORE_ID}")
-
-            # Create assistant with existing vector store (no file upload needed!)
-            assistants = client.beta.assistants.create(
-                name="ARFID Assistant",
-                description="This tool assists medical professionals and patients with identifying food options for patients with ARFID.",
-                instructions=instructions,
-                model="o3-mini",
-                tools=[{"type": "file_search"}],
-                tool_resources={"file_search": {"vector_store_ids": [OPENAI_VECTOR_STORE_ID]}},
-                response_format={
-                            "type": "json_schema",
-                            "json_schema": {
-                                "name": "ARFID_Meal_Recommendations",
-                                "schema": {
-                                    "type": "object",
-                                    "properties": {
-                                        "title": {
-                                            "type": "string",
-                                            "description": "The title of the meal recommendation schema."
-                                        },
-                                        "description": {
-                                            "type": "string",
-                                            "description": "A description of the purpose of the meal recommendations."
-                                        },
-                                        "recommendations": {
-                                            "type": "array",
-                                            "description": "A list of meal recommendations categorized by type.",
-                                            "items": {
-                                                "type": "object",
-                                                "properties": {
-                                                    "category": {
-                                                        "type": "string",
-                                                        "description": "The category of the meal recommendations."
-                                                    },
-                                                    "foods": {
-                                                        "type": "array",
-                                                        "description": "A list of food items with their respective goals and transition strategies.",
-                                                        "items": {
-                                                            "type": "object",
-                                                            "properties": {
-                                                                "food": {
-                                                                    "type": "string",
-                                                                    "description": "The name of the food item."
-                                                                },
-                                                                "goal": {
-                                                                    "type": "string",
-                                                                    "description": "The intended goal of including this food item."
-                                                                },
-                                                                "transition_strategy": {
-                                                                    "type": "string",
-                                                                    "description": "A strategy for transitioning the patient to accept this food."
-                                                                },
-                                                                "allergy_considerations": {
-                                                                    "type": "string",
-                                                                    "description": "Precautions or considerations for the food item."
-                                                                }
-                                                            },
-                                                            "required": [
-                                                                "food",
-                                                                "goal",
-                                                                "transition_strategy",
-                                                                "allergy_considerations"
-                                                            ],
-                                                            "additionalProperties": False
-                                                        }
-                                                    }
-                                                },
-                                                "required": [
-                                                    "category",
-                                                    "foods"
-                                                ],
-                                                "additionalProperties": False
-                                            }
-                                        },
-                                        "notes": {
-                                            "type": "array",
-                                            "description": "Additional notes or remarks regarding the meal recommendations.",
-                                            "items": {
-                                                "type": "object",
-                                                "properties": {
-                                                    "type": {
-                                                        "type": "string",
-                                                        "description": "The type of note (e.g., caution, encouragement)."
-                                                    },
-                                                    "content": {
-                                                        "type": "string",
-                                                        "description": "The content of the note."
-                                                    }
-                                                },
-                                                "required": [
-                                                    "type",
-                                                    "content"
-                                                ],
-                                                "additionalProperties": False
-                                            }
-                                        },
-                                        "recommendation_ease": {
-                                            "type": "array",
-                                            "description": "A list of recommendations with their ease of implementation.",
-                                            "items": {
-                                                "type": "object",
-                                                "properties": {
-                                                    "recommendation": {
-                                                        "type": "string",
-                                                        "description": "The recommendation for the patient."
-                                                    },
-                                                    "ease": {
-                                                        "type": "string",
-                                                        "description": "An explanation of why the recommendation is easy to implement."
-                                                    },
-                                                    "accomplishment": {
-                                                        "type": "string",
-                                                        "description": "An explanation of what the recommendation accomplishes."
-                                                    },
-                                                    "preparation": {
-                                                        "type": "string",
-                                                        "description": "An explanation of how the recommendation can be prepared."
-                                                    }
-                                                },
-                                                "required": [
-                                                    "recommendation",
-                                                    "ease",
-                                                    "accomplishment",
-                                                    "preparation"
-                                                ],
-                                                "additionalProperties": False
-                                            }
-                                        }
-                                    },
-                                    "required": [
-                                        "title",
-                                        "description",
-                                        "recommendations",
-                                        "notes",
-                                        "recommendation_ease"
-                                    ],
-                                    "additionalProperties": False
-                                },
-                                "strict": True
-                            }
-                        },
-                        reasoning_effort="medium"
-                    )
-            
-            raw_assistant_id = assistants.id
-            hashed_key = hashlib.sha256(raw_assistant_id.encode("utf-8")).hexdigest()
+            # Sessions share one assistant per configuration instead of creating their own
+            fingerprint_key = f"assistant_by_fp:{ASSISTANT_FINGERPRINT}"
+            raw_assistant_id = OPENAI_ASSISTANT_ID or redis_client.get(fingerprint_key)
+            stale_assistant_id = None
+            if raw_assistant_id and not OPENAI_ASSISTANT_ID:
+                try:
+                    client.beta.assistants.retrieve(raw_assistant_id)
+                    logger.info("Reusing assistant %s for configuration %s", raw_assistant_id, ASSISTANT_FINGERPRINT)
+                except NotFoundError:
+                    logger.warning("Assistant %s no longer exists in OpenAI, will create new one", raw_assistant_id)
+                    stale_assistant_id = raw_assistant_id
+                    raw_assistant_id = None
+
+            if not raw_assistant_id:
+                # Sessions starting together after a deploy would each create an assistant; only
+                # the lock holder does, and the rest pick up the id it stored
+                try:
+                    with redis_client.lock(
+                        f"{fingerprint_key}:lock",
+                        timeout=ASSISTANT_CREATE_LOCK_TIMEOUT,
+                        blocking_timeout=ASSISTANT_CREATE_LOCK_TIMEOUT
+                    ):
+                        raw_assistant_id = redis_client.get(fingerprint_key)
+                        if not raw_assistant_id or raw_assistant_id == stale_assistant_id:
+                            logger.info("Creating new assistant with vector store: %s", OPENAI_VECTOR_STORE_ID)
+                            raw_assistant_id = client.with_options(
+                                timeout=ASSISTANT_CREATE_TIMEOUT, max_retries=ASSISTANT_CREATE_MAX_RETRIES
+                            ).beta.assistants.create(**ASSISTANT_PARAMS).id
+                            redis_client.set(fingerprint_key, raw_assistant_id)
+                            logger.info("Assistant created with ID: %s", raw_assistant_id)
+                except LockNotOwnedError:
+                    # The lock expired before release; the assistant it guarded is still usable
+                    if not raw_assistant_id or raw_assistant_id == stale_assistant_id:
+                        raise
+                    logger.warning("Assistant creation lock for %s expired before release", ASSISTANT_FINGERPRINT)
+
+            # Each session gets its own key so threads and cleanup stay per user
+            hashed_key = hashlib.blake2b(f"{raw_assistant_id}:{uuid.uuid4().hex}".encode("utf-8"), digest_size=16).hexdigest()
 
             # Store assistant ID in Redis with hash key
             redis_key = f"assistant:{hashed_key}"
-            redis_client.set(redis_key, raw_assistant_id)
+            redis_client.set(redis_key, raw_assistant_id, ex=SESSION_TTL)
 
-            logger.info(f"Assistant created with ID: {raw_assistant_id} (hashed as: {hashed_key})")
+            logger.info("Assistant %s assigned to session key: %s", raw_assistant_id, hashed_key)
 
             return {"assistant_key": hashed_key, "status": "completed"}
 
     except Exception as e:
-        logger.error(f"Error in setup_assistant_task: {str(e)}")
+        logger.error("Error in setup_assistant_task: %s", e)
         return {"error": str(e)}
 
 @app.route("/health", methods=["GET"])
@@ -283,27 +427,27 @@ def start():
             raw_assistant_id = redis_client.get(redis_key)
 
             if raw_assistant_id:
-                raw_assistant_id = raw_assistant_id.decode("utf-8")
-                # Verify it exists in OpenAI
+                # Verify it exists in OpenAI, unless it is the pinned assistant
                 try:
-                    client.beta.assistants.retrieve(raw_assistant_id)
-                    logger.info(f"Reusing existing assistant for session: {existing_assistant_key}")
+                    if raw_assistant_id != OPENAI_ASSISTANT_ID:
+                        client.beta.assistants.retrieve(raw_assistant_id)
+                    logger.info("Reusing existing assistant for session: %s", existing_assistant_key)
                     return jsonify({
                         "assistant_key": existing_assistant_key,
                         "status": "existing",
                         "message": "Using existing assistant from session"
                     }), 200
                 except Exception as e:
-                    logger.warning(f"Assistant {raw_assistant_id} not found in OpenAI, will create new one: {e}")
+                    logger.warning("Assistant %s not found in OpenAI, will create new one: %s", raw_assistant_id, e)
                     # Continue to create new assistant below
             else:
-                logger.warning(f"Assistant key {existing_assistant_key} not found in Redis, will create new one")
+                logger.warning("Assistant key %s not found in Redis, will create new one", existing_assistant_key)
 
         # Start the background task to create new assistant
         task = setup_assistant_task.apply_async()
         return jsonify({"task_id": task.id, "status": "started"}), 202
     except Exception as e:
-        logger.error(f"Error starting assistant setup: {str(e)}")
+        logger.error("Error starting assistant setup: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/start/status", methods=["POST"])
@@ -346,7 +490,7 @@ def get_start_status():
             
         return jsonify(response)
     except Exception as e:
-        logger.error(f"Error checking task status: {str(e)}")
+        logger.error("Error checking task status: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/end", methods=["POST"])
@@ -357,23 +501,24 @@ def end():
         if not assistant_key:    
             return jsonify({"error": "No assistant found"}), 400
         redis_key= f"assistant:{assistant_key}"
-        raw_assistant_id = redis_client.get(redis_key)
+        # The assistant is shared across sessions, so only this session's mappings are removed.
+        # Read and delete them in one round trip.
+        pipe = redis_client.pipeline()
+        pipe.get(redis_key)
+        pipe.delete(redis_key, f"thread:{assistant_key}")
+        raw_assistant_id, _ = pipe.execute()
         if not raw_assistant_id:
             return jsonify({"error": "Assistant not found in Redis or expired"}), 400
-        raw_assistant_id = raw_assistant_id.decode("utf-8")
-        client.beta.assistants.delete(raw_assistant_id)
-        logger.info(f"Assistant with ID {raw_assistant_id} deleted.")
+        logger.info("Session %s released assistant %s.", assistant_key, raw_assistant_id)
         session.pop('assistant_key', None)
-        redis_client.delete(redis_key)
-        return jsonify({"message": "Assistant deleted successfully"}), 200
+        return jsonify({"message": "Assistant session ended successfully"}), 200
     except Exception as e:
-        logger.error(f"Error in /api/end: {str(e)}")
+        logger.error("Error in /api/end: %s", e)
         return jsonify({"error": str(e)}), 500
     
 @app.route('/api/create_message', methods=['POST'])
 def create_message():
-    logging.info("Flask route /create_message received a request.")
-    query = None
+    logger.info("Flask route /create_message received a request.")
     try:
         data = request.get_json()
         prompt1 = data.get("patient_likes")
@@ -384,78 +529,177 @@ def create_message():
         assistant_key = data.get("assistant_key")
         if (initial and not prompt1 and not prompt2 and not prompt3) or (not initial and not update):
             return jsonify( { "error": "All inputs are required" }, status=400 )
-     
-        if initial:
-            # Create a new thread for the first message
-            thread =  client.beta.threads.create()
-            thread_id = thread.id
-            os.environ["THREAD_ID"] = thread_id
-            session["THREAD_ID"] = thread_id
-            client.beta.threads.messages.create(
-                thread_id=thread.id, role="user", content=f"Include these foods of patients {prompt1}"
-            )
-            client.beta.threads.messages.create(
-                thread_id=thread.id, role="user", content=f"Do not include these foods patient doesn't like or eats: {prompt2}"
-            )
-            client.beta.threads.messages.create(
-                thread_id=thread.id, role="user", content=f"Each recommendation should build on one of these foods {prompt1} or provide an alternative to one of these foods {prompt2}"
-            )
-            client.beta.threads.messages.create(
-                thread_id=thread.id, role="user", content=f"Patient is allergic or has restrictions and can't eat: {prompt3}"
-            ) 
-        else: 
-            thread_id = os.environ.get("THREAD_ID") or session.get("THREAD_ID")
-            client.beta.threads.messages.create(
-                thread_id=thread_id, content=update, role="user"
-            )
         if not assistant_key:
             return jsonify({"error": "Assistant not found in session"}), 400
         redis_key= f"assistant:{assistant_key}"
-        raw_assistant_id = redis_client.get(redis_key)
+        thread_key = f"thread:{assistant_key}"
+        cache_key = None
+        # Fetch the assistant and thread mappings in a single round trip
+        raw_assistant_id, thread_id = redis_client.mget(redis_key, thread_key)
         if not raw_assistant_id:
             return jsonify({"error": "Assistant not found in Redis or expired"}), 400
-        raw_assistant_id = raw_assistant_id.decode("utf-8")
-        # task = asyncio.create_task(run_openai(thread_id, raw_assistant_id))
-        # ongoing_tasks[task_id] = task
-        task = run_openai_task.apply_async(args=[thread_id, raw_assistant_id])
+
+        if initial:
+            # Normalize once so equivalent inputs share a cache entry and prompt
+            prompt1 = normalize_food_list(prompt1)
+            prompt2 = normalize_food_list(prompt2)
+            prompt3 = normalize_food_list(prompt3)
+            # Keyed on the session's own assistant, which may predate the current configuration
+            cache_key = get_response_cache_key(raw_assistant_id, prompt1, prompt2, prompt3)
+            cached = redis_client.get(cache_key)
+            # Send the patient details as one ordered message instead of four round trips
+            content = INITIAL_MESSAGE_TEMPLATE.format(likes=prompt1, dislikes=prompt2, restrictions=prompt3)
+            initial_messages = [{"role": "user", "content": content}]
+            if cached:
+                # Record the cached answer on the thread so later updates keep their context
+                initial_messages.append({"role": "assistant", "content": cached})
+            # Create a new thread with its first messages in a single request
+            thread =  client.beta.threads.create(messages=initial_messages)
+            thread_id = thread.id
+            redis_client.setex(thread_key, SESSION_TTL, thread_id)
+            if cached:
+                logger.info("Serving cached response for key: %s", cache_key)
+                return jsonify({"task_id": f"{RESPONSE_CACHE_PREFIX}{cache_key}"}), 202
+            # Identical inputs already being answered share that run instead of starting another.
+            # The thread is queued atomically with the check, so the leader's task is sure to
+            # seed it with the answer when it finishes.
+            task_id = str(uuid.uuid4())
+            waiters_key = f"{WAITERS_PREFIX}{cache_key}"
+            pipe = redis_client.pipeline()
+            pipe.set(f"{INFLIGHT_PREFIX}{cache_key}", task_id, nx=True, ex=INFLIGHT_TTL)
+            pipe.get(f"{INFLIGHT_PREFIX}{cache_key}")
+            pipe.rpush(waiters_key, thread_id)
+            pipe.expire(waiters_key, TASK_VISIBILITY_TIMEOUT)
+            claimed, leader_task_id, _, _ = pipe.execute()
+            if not claimed:
+                logger.info("Joining in-flight task %s for key: %s", leader_task_id, cache_key)
+                return jsonify({"task_id": leader_task_id}), 202
+            task = run_openai_task.apply_async(args=[thread_id, raw_assistant_id, cache_key], task_id=task_id)
+            return jsonify({"task_id": task.id}), 202
+        else:
+            if not thread_id:
+                return jsonify({"error": "Thread ID not found"}), 400
+            client.beta.threads.messages.create(
+                thread_id=thread_id, content=update, role="user"
+            )
+        task = run_openai_task.apply_async(args=[thread_id, raw_assistant_id, cache_key])
 
         return jsonify({"task_id": task.id}), 202
     except Exception as e:
-        logger.error(f"Error in /create_message: {str(e)}")
+        logger.error("Error in /create_message: %s", e)
         return jsonify(error=str(e), status=500)
 
-@celery.task 
-def run_openai_task(thread_id, assistant_id):
-    logger.info(f"Running OpenAI task with thread ID: {thread_id} and assistant ID: {assistant_id}")
-    try:
-        with app.app_context():
-            run = client.beta.threads.runs.create_and_poll(
-              thread_id=thread_id, assistant_id=assistant_id, instructions=instructions,
-              poll_interval_ms=10000
+@celery.task(bind=True)
+def run_openai_task(self, thread_id, assistant_id, cache_key=None):
+    """Run the assistant on the thread and publish the outcome for /api/stream listeners"""
+    # With acks_late the broker can deliver the same task again (lost worker, visibility
+    # timeout). A delivery that already stored its result is dropped. One whose claim is still
+    # being refreshed is checked again once the claim could have lapsed, so work lost with a
+    # dead worker is picked up instead of being dropped with it.
+    if self.AsyncResult(self.request.id).ready():
+        logger.warning("Task %s already finished, skipping redelivery", self.request.id)
+        raise Ignore()
+    claim_key = f"{RUN_CLAIM_PREFIX}{self.request.id}"
+    if not redis_client.set(claim_key, thread_id, nx=True, ex=RUN_CLAIM_TTL):
+        logger.warning("Task %s is running elsewhere, checking again in %ss", self.request.id, RUN_CLAIM_TTL)
+        self.apply_async(
+            args=self.request.args, kwargs=self.request.kwargs,
+            task_id=self.request.id, countdown=RUN_CLAIM_TTL
+        )
+        raise Ignore()
+    task_id = self.request.id
+
+    def refresh_claims():
+        redis_client.expire(claim_key, RUN_CLAIM_TTL)
+        if cache_key:
+            refresh_if_owner(keys=[f"{INFLIGHT_PREFIX}{cache_key}"], args=[task_id, INFLIGHT_TTL])
+
+    with keep_alive(refresh_claims, RUN_CLAIM_TTL / 3):
+        result = run_openai(thread_id, assistant_id, cache_key, f"{DELTA_CHANNEL_PREFIX}{task_id}")
+        if cache_key:
+            release_waiters(cache_key, task_id, thread_id, result)
+    return result
+
+@task_success.connect
+def publish_run_result(sender=None, result=None, **kwargs):
+    """Tell /api/stream listeners a run finished, once its result is stored and readable"""
+    if sender.name != run_openai_task.name:
+        return
+    redis_client.publish(
+        f"{RESULT_CHANNEL_PREFIX}{sender.request.id}", orjson.dumps({"state": "SUCCESS", "result": result})
+    )
+
+def release_waiters(cache_key, task_id, thread_id, result):
+    """End task_id's in-flight claim on cache_key and copy a successful result onto the joined threads"""
+    waiters_key = f"{WAITERS_PREFIX}{cache_key}"
+    pipe = redis_client.pipeline()
+    # A claim that lapsed may already belong to a newer run; leave that one in place
+    delete_if_owner(keys=[f"{INFLIGHT_PREFIX}{cache_key}"], args=[task_id], client=pipe)
+    pipe.lrange(waiters_key, 0, -1)
+    pipe.delete(waiters_key)
+    _, waiting_threads, _ = pipe.execute()
+    if not isinstance(result, str):
+        return
+    for waiting_thread_id in waiting_threads:
+        if waiting_thread_id == thread_id:
+            continue
+        try:
+            # Record the shared answer so each session's later updates keep their context
+            client.beta.threads.messages.create(
+                thread_id=waiting_thread_id, content=result, role="assistant"
             )
-            logger.info(f"Runs: {run}")
-            logger.info(f"Run status: {run.status}")
-            if run.status == "completed":
-                logger.info(f"Run completed: {run}")
-                messages =  client.beta.threads.messages.list(thread_id=thread_id)
-                assistant_messages = []
-                logger.info(f"Messages: {messages.data}")
-                logger.info(f"Messages: {messages}")
-                if len(messages.data) > 0:
-                    for msg in messages.data:
-                        if msg.role == "assistant":
-                            logger.info(f"Assistant message: {msg}")
-                            logger.info(f"Assistant role message: {msg.role}")
-                            assistant_messages.append({ "role": msg.role, "content": msg.content })
-                logger.info(f"Type Assistant messages: {type(assistant_messages)}")
-                logger.info(f"Assistant messages: {assistant_messages}")
-                if(len(assistant_messages) > 0):
-                    return assistant_messages[0]["content"][0].text.value
-                else:
-                    return {"error": "No assistant messages found, please resubmit response"}, 500
-                    
+        except Exception as e:
+            logger.error("Error seeding thread %s with shared result: %s", waiting_thread_id, e)
+
+def run_openai(thread_id, assistant_id, cache_key=None, delta_channel=None):
+    logger.info("Running OpenAI task with thread ID: %s and assistant ID: %s", thread_id, assistant_id)
+    try:
+        # The assistant already carries the instructions; overriding them per run
+        # resends ~1.5 KB and breaks the stable prefix OpenAI prompt caching relies on.
+        # Streaming the run replaces status polling and returns the new messages directly,
+        # so the thread's full history is never re-fetched.
+        with client.beta.threads.runs.stream(
+          thread_id=thread_id, assistant_id=assistant_id
+        ) as stream:
+            if delta_channel:
+                # Forward partial output so /api/stream clients can render before the run ends
+                pending = []
+                last_publish = time.monotonic()
+                for text in stream.text_deltas:
+                    pending.append(text)
+                    if time.monotonic() - last_publish >= DELTA_PUBLISH_INTERVAL:
+                        redis_client.publish(delta_channel, "".join(pending))
+                        pending.clear()
+                        last_publish = time.monotonic()
+                if pending:
+                    redis_client.publish(delta_channel, "".join(pending))
+            stream.until_done()
+            run = stream.get_final_run()
+            final_messages = stream.get_final_messages()
+        logger.info("Run %s finished with status: %s", run.id, run.status)
+        logger.debug("Run details: %s", run)
+        if run.status == "completed":
+            assistant_messages = [msg for msg in final_messages if msg.role == "assistant"]
+            logger.debug("Assistant messages: %d", len(assistant_messages))
+            if(len(assistant_messages) > 0):
+                raw_result = assistant_messages[-1].content[0].text.value
+                try:
+                    result = ARFIDResponse.model_validate_json(raw_result).model_dump_json()
+                except ValidationError as e:
+                    logger.error("Assistant response failed validation: %s", e)
+                    return {"error": "Assistant returned an invalid response, please resubmit", "status": 500}
+                if cache_key:
+                    redis_client.setex(cache_key, RESPONSE_CACHE_TTL, result)
+                return result
+            else:
+                return {"error": "No assistant messages found, please resubmit response", "status": 500}
+        # Failed, cancelled, expired or incomplete runs must not look like an empty success
+        error = run.last_error.message if run.last_error else f"Run ended with status: {run.status}"
+        logger.error("Run %s did not complete: %s", run.id, error)
+        return {"error": error, "status": 500}
+
     except Exception as e:
-        logger.error(f"Error in run_openai: {str(e)}")
+        logger.error("Error in run_openai: %s", e)
         return {"error": str(e), "status": 500}
     
 @app.route('/api/update_with_selections', methods=['POST'])
@@ -465,39 +709,35 @@ def submit_recommendations():
     assistant_key = data.get("assistant_key")
     update = data.get("update")
     # Process the recommendations and notes as needed
-    logger.info(f"Recommendations: {recommendations}")
-    thread_id = os.environ.get("THREAD_ID") or session.get("THREAD_ID")
-    if not thread_id:
-        return jsonify({"error": "Thread ID not found"}), 400
-    client.beta.threads.messages.create(
-        thread_id=thread_id, content=f"Updates from user: {update}", role="user"
-    )
-    client.beta.threads.messages.create(
-        thread_id=thread_id, content=f"The user has provided the following recommendations: {recommendations}, please give more suggestions like that.", role="user"
-    )
-    client.beta.threads.messages.create(
-        thread_id=thread_id, content="Please provide 20 recommendations in the same format as before.", role="user"
-    )
+    logger.debug("Recommendations: %s", recommendations)
     if not assistant_key:
         return jsonify({"error": "Assistant not found in session"}), 400
     redis_key= f"assistant:{assistant_key}"
-    raw_assistant_id = redis_client.get(redis_key)
+    # Fetch the assistant and thread mappings in a single round trip
+    raw_assistant_id, thread_id = redis_client.mget(redis_key, f"thread:{assistant_key}")
+    if not thread_id:
+        return jsonify({"error": "Thread ID not found"}), 400
     if not raw_assistant_id:
         return jsonify({"error": "Assistant not found in Redis or expired"}), 400
-    raw_assistant_id = raw_assistant_id.decode("utf-8")
+    # One consolidated user turn instead of three sequential round trips
+    content = SELECTIONS_MESSAGE_TEMPLATE.format(update=update, recommendations=recommendations)
+    client.beta.threads.messages.create(
+        thread_id=thread_id, content=content, role="user"
+    )
     task = run_openai_task.apply_async(args=[thread_id, raw_assistant_id])
     return jsonify({"task_id": task.id}), 202
 
-@app.route('/api/get_message', methods=['POST'])
-def get_message():
-    data = request.get_json()
-    task_id = data.get("task_id")
-    logger.info(f"Getting message for task_id: {task_id}")
-    if not task_id:
-        return jsonify({"error": "task_id is required"}), 400
+def get_task_response(task_id):
+    """Build the client-facing state for a Celery task id or a cached response id"""
+    if task_id.startswith(RESPONSE_CACHE_PREFIX):
+        cache_key = task_id[len(RESPONSE_CACHE_PREFIX):]
+        if not RESPONSE_CACHE_KEY_PATTERN.fullmatch(cache_key):
+            return {"state": "FAILURE", "error": "Invalid task_id"}
+        cached = redis_client.get(cache_key)
+        if not cached:
+            return {"state": "FAILURE", "error": "Cached response expired, please resubmit"}
+        return {"state": "SUCCESS", "result": cached}
     task = AsyncResult(task_id, app=celery)
-    logger.info(f"Task: {task}")
-    logger.info(f"Task result: {task.result}")
     if task.state == 'PENDING':
         response = {
             'state': task.state,
@@ -514,8 +754,60 @@ def get_message():
             'state': task.state,
             'error': str(task.info)
         }
-    return jsonify(response)
-    
+    return response
+
+@app.route('/api/get_message', methods=['POST'])
+def get_message():
+    data = request.get_json()
+    task_id = data.get("task_id")
+    logger.info("Getting message for task_id: %s", task_id)
+    if not task_id:
+        return jsonify({"error": "task_id is required"}), 400
+    return jsonify(get_task_response(task_id))
+
+@app.route('/api/stream/<task_id>', methods=['GET'])
+def stream_message(task_id):
+    """Push the task result over Server-Sent Events instead of having the client poll get_message.
+
+    Partial output is sent as "delta" events while the run is generating; the final
+    default event carries the same payload get_message would return.
+    """
+    def generate():
+        pubsub = pubsub_client.pubsub(ignore_subscribe_messages=True)
+        delta_channel = f"{DELTA_CHANNEL_PREFIX}{task_id}"
+        pubsub.subscribe(f"{RESULT_CHANNEL_PREFIX}{task_id}", delta_channel)
+        try:
+            # The task may have finished before we subscribed
+            response = get_task_response(task_id)
+            if response["state"] in ("SUCCESS", "FAILURE"):
+                yield f"data: {json.dumps(response)}\n\n"
+                return
+            deadline = time.monotonic() + STREAM_TIMEOUT
+            while time.monotonic() < deadline:
+                message = pubsub.get_message(timeout=STREAM_KEEPALIVE_INTERVAL)
+                if message and message["channel"] == delta_channel:
+                    yield f"event: delta\ndata: {json.dumps(message['data'])}\n\n"
+                    continue
+                if message:
+                    yield f"data: {message['data']}\n\n"
+                    return
+                # Also catch results whose publish went out before we subscribed
+                response = get_task_response(task_id)
+                if response["state"] in ("SUCCESS", "FAILURE"):
+                    yield f"data: {json.dumps(response)}\n\n"
+                    return
+                # Comment lines keep proxies from closing an idle connection
+                yield ": keepalive\n\n"
+            yield f"event: timeout\ndata: {json.dumps(get_task_response(task_id))}\n\n"
+        finally:
+            pubsub.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 if __name__ == '__main__':
     app.run(debug=True, use_reloader=True)
         
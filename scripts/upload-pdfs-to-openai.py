@@ -4,7 +4,10 @@ One-time script to upload PDFs to OpenAI and create permanent vector store.
 
 Usage:
     export OPENAI_API_KEY='your-key-here'
-    python scripts/upload-pdfs-to-openai.py
+    python scripts/upload-pdfs-to-openai.py [--wait]
+
+By default the script returns as soon as the files are uploaded and OpenAI has
+started indexing them; pass --wait to poll until indexing finishes.
 
 This script:
 1. Finds all PDF files in the ./files directory
@@ -18,12 +21,41 @@ After running this script, you'll need to:
 3. Never run this script again (unless PDFs change)
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 from openai import OpenAI
+import hashlib
 import os
 import sys
 from pathlib import Path
 
+# Files are uploaded on parallel connections; one stream rarely saturates the uplink
+UPLOAD_CONCURRENCY = 6
+
+def dedupe_by_content(paths):
+    """Drop files whose bytes match an earlier file, keeping the first path in sorted order"""
+    unique, seen = [], {}
+    for path in paths:
+        # Hashed in chunks so large PDFs are never held in memory whole
+        with open(path, "rb") as stream:
+            digest = hashlib.file_digest(stream, "sha256").hexdigest()
+        if digest in seen:
+            print(f"   - Skipping {path.name} (same content as {seen[digest].name})")
+            continue
+        seen[digest] = path
+        unique.append(path)
+    return unique
+
+def upload_file(client, path):
+    """Upload one PDF for use by assistants and return its file ID"""
+    with open(path, "rb") as stream:
+        return client.files.create(file=stream, purpose="assistants").id
+
 def main():
+    parser = argparse.ArgumentParser(description="Upload the ARFID PDFs to a new OpenAI vector store")
+    parser.add_argument("--wait", action="store_true", help="poll until OpenAI finishes indexing the files")
+    args = parser.parse_args()
+
     print("=" * 70)
     print("ARFID PDF Upload to OpenAI Vector Store")
     print("=" * 70)
@@ -46,7 +78,7 @@ def main():
         print(f"\n❌ ERROR: Files directory not found: {files_dir}")
         sys.exit(1)
 
-    pdf_files = sorted(list(files_dir.glob("*.pdf")))
+    pdf_files = dedupe_by_content(sorted(files_dir.glob("*.pdf")))
 
     if not pdf_files:
         print(f"\n❌ ERROR: No PDF files found in {files_dir}")
@@ -84,19 +116,25 @@ def main():
     print(f"\n📤 Uploading {len(pdf_files)} PDFs to OpenAI...")
     print("   (This may take several minutes for large files)")
 
-    file_streams = []
-
     try:
-        # Open all file streams
-        for pdf_path in pdf_files:
-            file_streams.append(open(pdf_path, "rb"))
-
-        # Batch upload with progress polling
-        file_batch = client.vector_stores.file_batches.upload_and_poll(
-            vector_store_id=vector_store.id,
-            files=file_streams,
-            poll_interval_ms=2000
-        )
+        # Upload in parallel, each worker opening and closing its own file, then attach
+        # them all to the vector store as one batch
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+            file_ids = list(executor.map(lambda path: upload_file(client, path), pdf_files))
+        print(f"   - Uploaded {len(file_ids)} files, indexing...")
+
+        # Indexing runs on OpenAI's side; only poll for it when asked to
+        if args.wait:
+            file_batch = client.vector_stores.file_batches.create_and_poll(
+                vector_store_id=vector_store.id,
+                file_ids=file_ids,
+                poll_interval_ms=2000
+            )
+        else:
+            file_batch = client.vector_stores.file_batches.create(
+                vector_store_id=vector_store.id,
+                file_ids=file_ids
+            )
 
         # Check status
         if file_batch.status == "completed":
@@ -124,14 +162,6 @@ def main():
         print(f"\n❌ ERROR during upload: {e}")
         sys.exit(1)
 
-    finally:
-        # Always close file streams
-        for stream in file_streams:
-            try:
-                stream.close()
-            except:
-                pass
-
     # Success! Print instructions
     print("\n" + "=" * 70)
     print("🎉 SUCCESS! PDFs uploaded to OpenAI")